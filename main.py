@@ -1,7 +1,11 @@
 from flask import Flask, request, jsonify, send_from_directory
-import os, tempfile, logging, io, zipfile, requests, duckdb, geopandas as gpd, pandas as pd
-import shapely, pyproj, ezdxf
-from shapely.geometry import Polygon, MultiPolygon
+from array import array
+import os, re, math, time, fcntl, tempfile, logging, functools, hashlib, threading, requests, orjson, ijson, diskcache, cachetools, duckdb, geopandas as gpd, pandas as pd
+import numpy as np, shapely, pyproj, ezdxf
+from ezdxf.addons import r12writer
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ── CONFIG ──────────────────────────────────────────────────────────────────────
 OV_RELEASE      = "2025-06-25.0"
@@ -9,6 +13,9 @@ NOMINATIM_EMAIL = os.getenv("NOMINATIM_EMAIL", "you@example.com")
 TARGET_CRS      = "EPSG:32644"
 DEFAULT_BUFFER  = 250
 OVERPASS        = "https://overpass.kumi.systems/api/interpreter"
+OVERPASS_TIMEOUT = 90            # QL [timeout:] seconds; client waits a little longer
+OSM_LAYERS      = ("ROAD", "WATER")
+DXF_TTL         = 86400          # seconds a generated DXF is served from disk
 # ────────────────────────────────────────────────────────────────────────────────
 
 logging.basicConfig(level=logging.INFO,
@@ -18,65 +25,200 @@ log = logging.getLogger("place2dxf")
 
 app = Flask(__name__)
 
+# one pooled keep-alive session for Nominatim / Overpass / Overture
+# (Overpass queries are POSTed but idempotent, so POST is retried too)
+SESSION = requests.Session()
+_RETRY = Retry(total=3, backoff_factor=0.3,
+               allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=_RETRY))
+# Overpass JSON compresses 5-10×; br is decoded by urllib3 via the brotli package
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate, br"})
+
+# PROJ pipelines are costly to build → construct once, reuse per request
+TRANSFORMER_4326_TO_TARGET = pyproj.Transformer.from_crs(4326, TARGET_CRS, always_xy=True)
+TRANSFORMER_TARGET_TO_4326 = pyproj.Transformer.from_crs(TARGET_CRS, 4326, always_xy=True)
+
+# DuckDB: httpfs + S3 settings once at import; per-call cursors share it
+# (httpfs is INSTALLed at image build; WKB is decoded by shapely, so no spatial)
+_DUCK = duckdb.connect()
+_DUCK.execute("INSTALL httpfs; LOAD httpfs;"
+              "SET s3_region='us-west-2'; SET enable_object_cache=true;")
+
+# DXFs live directly in the temp dir (served by /files); locks + geocode store
+# live in a private subdir that /files never serves
+_STATE_DIR = os.path.join(tempfile.gettempdir(), "place2dxf_state")
+os.makedirs(_STATE_DIR, exist_ok=True)
+_DXF_NAME = re.compile(r"[0-9a-f]{16}\.dxf")
+
+# geocodes survive restarts → Nominatim sees each place once
+_GEO_DISK = diskcache.Cache(os.path.join(_STATE_DIR, "geo_cache"))
+
 # ── helpers ────────────────────────────────────────────────────────────────────
+def to_target(geoms):
+    """Project an EPSG:4326 geometry array to TARGET_CRS in one PROJ call."""
+    geoms = np.array(geoms, dtype=object)   # set_coordinates writes in place
+    if len(geoms) == 0:
+        return geoms
+    coords = shapely.get_coordinates(geoms)
+    xs, ys = TRANSFORMER_4326_TO_TARGET.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geoms, np.column_stack((xs, ys)))
+
 def geocode(place):
-    r = requests.get("https://nominatim.openstreetmap.org/search",
-                     params={"q": place, "format": "json", "limit": 1,
-                             "email": NOMINATIM_EMAIL}, timeout=10)
+    return _geocode(place.strip().lower())
+
+@functools.lru_cache(maxsize=4096)
+def _geocode(place):
+    hit = _GEO_DISK.get(place)
+    if hit is not None:
+        log.info("[GEO] %s → %.6f, %.6f (cached)", place, *hit)
+        return hit
+    r = SESSION.get("https://nominatim.openstreetmap.org/search",
+                    params={"q": place, "format": "json", "limit": 1,
+                            "email": NOMINATIM_EMAIL}, timeout=10)
     r.raise_for_status()
-    lat, lon = float(r.json()[0]["lat"]), float(r.json()[0]["lon"])
+    hit = orjson.loads(r.content)[0]
+    lat, lon = float(hit["lat"]), float(hit["lon"])
     log.info("[GEO] %s → %.6f, %.6f", place, lat, lon)
+    _GEO_DISK.set(place, (lat, lon))
     return lat, lon
 
-def extract_buildings_api(bbox):
-    minLon, minLat, maxLon, maxLat = bbox
-    url = (f"https://extract.overturemaps.org/extract.json"
-           f"?bbox={minLon},{minLat},{maxLon},{maxLat}&layers=buildings")
-    log.info("[API] %s", url)
-    meta = requests.get(url, timeout=20).json()
-    zip_url = meta["layers"]["buildings"]["gpkg"]
-    log.info("[DL ] %s", zip_url.split("/")[-1])
-    blob = requests.get(zip_url, timeout=30).content
-    with zipfile.ZipFile(io.BytesIO(blob)) as zf:
-        with zf.open(zf.namelist()[0]) as f:
-            gdf = gpd.read_file(f)
-    return gdf.to_crs(TARGET_CRS)
-
 def extract_buildings_parquet(bbox):
-    xmin, ymin, xmax, ymax = bbox
-    box_sql = f"ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax})"
+    minLon, minLat, maxLon, maxLat = bbox
     url = (f"s3://overturemaps-us-west-2/release/{OV_RELEASE}/"
-           f"theme=buildings/type=building/**")
-    log.info("[SLOW] parquet scan buildings …")
-    con = duckdb.connect()
-    con.execute("LOAD spatial;")
-    df = con.sql(f"""
-        SELECT *, ST_GeomFromWKB(geometry) AS geom
-        FROM parquet_scan('{url}')
-        WHERE ST_Intersects(ST_GeomFromWKB(geometry), {box_sql})
-    """).fetchdf()
-    con.close()
-    if df.empty:
-        return gpd.GeoDataFrame(columns=["geometry"], crs=4326).to_crs(TARGET_CRS)
-    df = df.drop(columns=["geometry"]).rename(columns={"geom": "geometry"})
-    return gpd.GeoDataFrame(df, geometry="geometry", crs=4326).to_crs(TARGET_CRS)
+           f"theme=buildings/type=building/*")
+    log.info("[PQ ] bbox scan buildings %.5f,%.5f,%.5f,%.5f", minLon, minLat, maxLon, maxLat)
+    con = _DUCK.cursor()
+    try:
+        # bbox struct overlap test → row-group skipping via parquet min/max stats
+        df = con.sql(f"""
+            SELECT geometry
+            FROM read_parquet('{url}', hive_partitioning=1)
+            WHERE bbox.xmin <= {maxLon} AND bbox.xmax >= {minLon}
+              AND bbox.ymin <= {maxLat} AND bbox.ymax >= {minLat}
+        """).fetchdf()
+    finally:
+        con.close()
+    geoms = shapely.from_wkb(df["geometry"].map(bytes).values)
+    log.info("[RES] buildings %d", len(geoms))
+    return gpd.GeoDataFrame(geometry=to_target(geoms), crs=TARGET_CRS)
+
+# query built once; POST body avoids URL-length limits on the union query
+_OVERPASS_TMPL = ("[out:json][timeout:%(timeout)d];(way[highway](%(bb)s);way[waterway](%(bb)s);"
+                  "way[natural=water](%(bb)s);relation[natural=water](%(bb)s););out geom;")
+
+_RUNTIME_REMARK = re.compile(rb'"remark"\s*:\s*"(runtime error(?:[^"\\]|\\.)*)"')
+
+class _TailReader:
+    """File wrapper that keeps the last few KB read, so the trailing "remark"
+    can be checked without leaving ijson's C backend."""
+    def __init__(self, raw, keep=4096):
+        self.raw, self.keep, self.tail = raw, keep, b""
+
+    def read(self, n=-1):
+        chunk = self.raw.read(n)
+        self.tail = (self.tail + chunk)[-self.keep:]
+        return chunk
+
+def overpass_lines(bbox):
+    """Roads + water in one Overpass round trip, split client-side into DXF layers."""
+    s, w, n, e = bbox[1], bbox[0], bbox[3], bbox[2]
+    data = (_OVERPASS_TMPL % {"bb": "%f,%f,%f,%f" % (s, w, n, e),
+                              "timeout": OVERPASS_TIMEOUT}).encode("ascii")
+    r = SESSION.post(OVERPASS, data=data, headers={"Content-Type": "text/plain"},
+                     timeout=OVERPASS_TIMEOUT + 5, stream=True)
+    # stream elements as bytes arrive; vertices go straight into flat C buffers
+    xy, idx, layers = array("d"), array("i"), []
+    with r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        body = _TailReader(r.raw)
+        for el in ijson.items(body, "elements.item", use_float=True):
+            layer = "ROAD" if "highway" in el.get("tags", {}) else "WATER"
+            # relations carry their outline as member way geometries
+            parts = [el.get("geometry")] if el["type"] == "way" else \
+                    [m.get("geometry") for m in el.get("members", ())]
+            for pts in parts:
+                if pts and len(pts) > 1:
+                    for p in pts:
+                        xy.append(p["lon"]); xy.append(p["lat"])
+                    idx.extend([len(layers)] * len(pts))
+                    layers.append(layer)
+        while body.read(1 << 16):   # make sure the tail holds the document end
+            pass
+    # a server-side timeout still answers 200 with partial elements → never cache that
+    remark = _RUNTIME_REMARK.search(body.tail)
+    if remark:
+        raise RuntimeError(f"Overpass: {remark.group(1).decode(errors='replace')}")
+    if layers:
+        lines = shapely.linestrings(np.frombuffer(xy, dtype=np.float64).reshape(-1, 2),
+                                    indices=np.frombuffer(idx, dtype=np.intc))
+    else:
+        lines = np.empty(0, dtype=object)
+    layers = np.array(layers, dtype=object)
+    # bare projected shapely arrays per layer; no GeoDataFrame/index on this path
+    out = {name: to_target(lines[layers == name]) for name in OSM_LAYERS}
+    log.info("[RES] %s", " ".join(f"{k.lower()} {len(v)}" for k, v in out.items()))
+    return out
+
+def snap(bbox, q=0.005):
+    """Expand bbox outward to a q-degree grid so nearby AOIs share a cache key."""
+    minLon, minLat, maxLon, maxLat = bbox
+    return (round(math.floor(minLon / q) * q, 6), round(math.floor(minLat / q) * q, 6),
+            round(math.ceil(maxLon / q) * q, 6),  round(math.ceil(maxLat / q) * q, 6))
+
+# snapped bbox → projected geometries (CRS transform amortised too)
+@cachetools.cached(cachetools.TTLCache(maxsize=128, ttl=3600), lock=threading.Lock())
+def _buildings_cell(cell):
+    return extract_buildings_parquet(cell)
+
+@cachetools.cached(cachetools.TTLCache(maxsize=128, ttl=3600), lock=threading.Lock())
+def _osm_cell(cell):
+    return overpass_lines(cell)
 
 def get_buildings(bbox):
+    return _buildings_cell(snap(bbox))
+
+def get_osm_lines(bbox):
+    return _osm_cell(snap(bbox))
+
+def _coord_groups(geoms):
+    """One (n, 2) float64 view per non-empty geometry, from a single coord buffer."""
+    if len(geoms) == 0:
+        return []
+    coords, idx = shapely.get_coordinates(geoms, return_index=True)
+    counts = np.bincount(idx, minlength=len(geoms))
+    return [xy for xy in np.split(coords, np.cumsum(counts)[:-1]) if len(xy)]
+
+def write_dxf(path, buildings, lines, r12=False):
+    # write beside the target then rename → readers never see a torn file
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
     try:
-        return extract_buildings_api(bbox)
-    except Exception as e:
-        log.warning("[WARN] extract API failed (%s) — falling back to Parquet", e.__class__.__name__)
-        return extract_buildings_parquet(bbox)
+        _emit_dxf(tmp, buildings, lines, r12)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
-def overpass_roads(bbox):
-    s, w, n, e = bbox[1], bbox[0], bbox[3], bbox[2]
-    q = f"[out:json];way[highway]({s},{w},{n},{e});out geom;"
-    r = requests.get(OVERPASS, params={"data": q}, timeout=25)
-    r.raise_for_status()
-    lines = [shapely.LineString([(p["lon"], p["lat"]) for p in el["geometry"]])
-             for el in r.json()["elements"]]
-    log.info("[RES] roads %d", len(lines))
-    return gpd.GeoDataFrame(geometry=lines, crs=4326).to_crs(TARGET_CRS)
+def _emit_dxf(path, buildings, lines, r12):
+    polys = buildings.geometry.explode(index_parts=False)
+    rings = shapely.get_exterior_ring(np.asarray(polys[polys.geom_type == "Polygon"]))
+    if r12:
+        # R12 streaming writer: tokens straight to disk, no in-memory DOM
+        with r12writer(path) as w:
+            for xy in _coord_groups(rings):
+                w.add_polyline_2d(xy[:-1], closed=True, layer="BLDG")
+            for layer, geoms in lines.items():
+                for xy in _coord_groups(geoms):
+                    w.add_polyline_2d(xy, layer=layer)
+        return
+    doc = ezdxf.new(); msp = doc.modelspace(); doc.layers.new("BLDG")
+    for xy in _coord_groups(rings):
+        msp.add_lwpolyline(xy, format="xy", dxfattribs={"layer": "BLDG"})
+    for layer, geoms in lines.items():
+        doc.layers.new(layer)
+        for xy in _coord_groups(geoms):
+            msp.add_lwpolyline(xy, format="xy", dxfattribs={"layer": layer})
+    doc.saveas(path)
 
 # ── route ──────────────────────────────────────────────────────────────────────
 @app.route("/dwg")
@@ -85,37 +227,66 @@ def make_dxf():
     if not place:
         return jsonify(error="missing ?place"), 400
     buf = float(request.args.get("buffer", DEFAULT_BUFFER))
+    fmt = request.args.get("format", "").lower()
+    if fmt not in ("", "r12"):
+        return jsonify(error="format must be r12 or omitted"), 400
 
-    lat, lon = geocode(place)
-    x, y = pyproj.Transformer.from_crs(4326, TARGET_CRS, always_xy=True).transform(lon, lat)
-    bbox4326 = gpd.GeoSeries([shapely.box(x-buf, y-buf, x+buf, y+buf)],
-                             crs=TARGET_CRS).to_crs(4326).total_bounds
+    # output is deterministic in (place, buf, fmt, release) → same key, same file
+    key = hashlib.sha1(f"{place.lower()}|{buf}|{fmt}|{OV_RELEASE}".encode()).hexdigest()[:16]
+    fname = f"{key}.dxf"            # never derived from raw input → no traversal
+    path = os.path.join(tempfile.gettempdir(), fname)
+    if _fresh(path):
+        log.info("[HIT] %s", fname)
+        if request.if_none_match.contains(key):
+            return "", 304
+        return _dxf_response(fname, key)
 
-    buildings = get_buildings(bbox4326)
-    roads     = overpass_roads(bbox4326)
+    # identical concurrent requests coalesce: one builds, the rest wait and reuse it
+    with open(os.path.join(_STATE_DIR, f"{key}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not _fresh(path):
+            build_dxf(place, buf, path, r12=(fmt == "r12"))
+    return _dxf_response(fname, key)
+
+def _fresh(path):
+    return os.path.exists(path) and time.time() - os.path.getmtime(path) < DXF_TTL
+
+def build_dxf(place, buf, path, r12=False):
+    lat, lon = geocode(place)
+    x, y = TRANSFORMER_4326_TO_TARGET.transform(lon, lat)
+    corners = [TRANSFORMER_TARGET_TO_4326.transform(cx, cy)
+               for cx in (x-buf, x+buf) for cy in (y-buf, y+buf)]
+    lons, lats = zip(*corners)
+    bbox4326 = (min(lons), min(lats), max(lons), max(lats))
 
-    tmp, fname = tempfile.gettempdir(), f"{place.replace(' ', '_')}.dxf"
-    doc = ezdxf.new(); msp = doc.modelspace(); doc.layers.new("BLDG"); doc.layers.new("ROAD")
+    # both fetches are network-bound → run side by side, wall time = max() not sum()
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fb, fl = ex.submit(get_buildings, bbox4326), ex.submit(get_osm_lines, bbox4326)
+        buildings, lines = fb.result(), fl.result()
 
-    def add_poly(poly): msp.add_lwpolyline(list(poly.exterior.coords), dxfattribs={"layer": "BLDG"})
-    for g in buildings.geometry:
-        if isinstance(g, Polygon): add_poly(g)
-        elif isinstance(g, MultiPolygon): [add_poly(p) for p in g.geoms]
+    # fetches cover the whole snapped cell → keep only what touches the true AOI
+    aoi_m = shapely.box(x-buf, y-buf, x+buf, y+buf)
+    buildings = buildings[shapely.intersects(np.asarray(buildings.geometry), aoi_m)]
+    lines = {k: g[shapely.intersects(g, aoi_m)] for k, g in lines.items()}
 
-    for ln in roads.geometry:
-        msp.add_lwpolyline(list(ln.coords), dxfattribs={"layer": "ROAD"})
+    write_dxf(path, buildings, lines, r12=r12)
+    log.info("[DXF] BLDG=%d %s", len(buildings),
+             " ".join(f"{k}={len(v)}" for k, v in lines.items()))
 
-    doc.saveas(os.path.join(tmp, fname))
-    log.info("[DXF] BLDG=%d ROAD=%d", len(buildings), len(roads))
-    return jsonify(status="ok", download_url=f"/files/{fname}")
+def _dxf_response(fname, key):
+    resp = jsonify(status="ok", download_url=f"/files/{fname}")
+    resp.set_etag(key)
+    return resp
 
-@app.route("/files/<path:fname>")
+@app.route("/files/<fname>")
 def download(fname):
+    if not _DXF_NAME.fullmatch(fname):
+        return jsonify(error="not found"), 404
     return send_from_directory(tempfile.gettempdir(), fname, as_attachment=True)
 
 @app.route("/")
 def hello():
-    return "Up — /dwg?place=Lucknow"
+    return "Up — /dwg?place=Lucknow[&buffer=250][&format=r12]"
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 3000)))